@@ -1,8 +1,15 @@
-import os
+from io import BytesIO
+from zipfile import ZipFile, ZIP_DEFLATED
 from openpyxl import Workbook
+from openpyxl.styles import NamedStyle
+from openpyxl.writer.excel import ExcelWriter
 from openpyxl.cell.cell import WriteOnlyCell
-import tempfile
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
 from collections import defaultdict
+from functools import lru_cache
 from decimal import Decimal
 from sql import Column
 from sql.aggregate import Sum
@@ -11,6 +18,7 @@ from trytond.report import Report
 from trytond.model import (ModelSQL, ModelView, MatchMixin, fields,
     sequence_ordered)
 from trytond.transaction import Transaction
+from trytond.tools import reduce_ids, grouped_slice
 from trytond.pool import Pool
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
@@ -18,6 +26,8 @@ from trytond.i18n import gettext
 __all__ = ['AnalyticDistributionReport', 'AnalyticDistributionReportRule',
     'SpreadsheetReport']
 _ZERO = Decimal(0)
+_FETCH_SIZE = 2048
+_SPREAD_CACHE_SIZE = 1024
 _FORMAT = '#,###,###,##0.00'
 
 
@@ -55,37 +65,77 @@ class AnalyticDistributionReport(ModelSQL, ModelView):
                         account=rule.source_analytic_account.rec_name,
                         report=self.rec_name))
 
-    def spread(self, analytic, amount):
-        res = {}
-        total = _ZERO
-        sign = 1 if amount >= 0 else -1
-        amount = abs(amount)
-        children = set([])
+    def spread_index(self):
+        # Map each source analytic account to its (target, ratio) list
+        index = defaultdict(list)
         for rule in self.rules:
-            if rule.source_analytic_account == analytic:
-                spread_amount = round(amount * Decimal(str(rule.ratio)))
+            index[rule.source_analytic_account.id].append(
+                (rule.target_analytic_account.id, Decimal(str(rule.ratio))))
+        return index
+
+    def spread(self, analytic, amount, index=None):
+        if index is None:
+            index = self.spread_index()
+        res = {}
+        stack = [(analytic.id, amount)]
+        while stack:
+            source_id, amount = stack.pop()
+            targets = index.get(source_id)
+            if not targets:
+                res[source_id] = res.get(source_id, _ZERO) + amount
+                continue
+
+            negative = amount.is_signed()
+            amount = amount.copy_abs()
+            spread = {}
+            total = _ZERO
+            for target_id, ratio in targets:
+                spread_amount = round(amount * ratio)
                 total += spread_amount
-                res[rule.target_analytic_account.id] = spread_amount
-                last = rule.target_analytic_account
-            elif rule.source_analytic_account.id in res:
-                children.add(rule.source_analytic_account)
-        if res and total != amount:
-            if not last.id in res:
-                res[last.id] = _ZERO
-            res[last.id] += round(total - amount)
-        elif not res:
-            res[analytic.id] = amount
-
-        for k, v in res.items():
-            res[k] *= sign
-
-        for child in children:
-            r = self.spread(child, res[child.id])
-            del res[child.id]
-            res.update(r)
+                spread[target_id] = spread_amount
+                last_target = target_id
+            if total != amount:
+                spread[last_target] += round(amount - total)
+            for target_id, spread_amount in spread.items():
+                if negative:
+                    spread_amount = spread_amount.copy_negate()
+                stack.append((target_id, spread_amount))
         return res
 
+    def simple_rules(self):
+        # Rules can be applied by the database when each source is fully
+        # moved to a single target that is not spread any further. The
+        # balances of the sources are then added before being rounded, so
+        # they must not need any currency conversion.
+        if not self.rules:
+            return False
+        sources, targets = set(), set()
+        for rule in self.rules:
+            source = rule.source_analytic_account
+            target = rule.target_analytic_account
+            if (source.id in sources
+                    or Decimal(str(rule.ratio)) != 1
+                    or source.currency != self.company.currency
+                    or target.currency != self.company.currency
+                    or target.type != 'normal'
+                    or not target.active):
+                return False
+            sources.add(source.id)
+            targets.add(target.id)
+        return not (sources & targets)
+
     def spreadsheet(self):
+        pool = Pool()
+        Analytic = pool.get('analytic_account.account')
+
+        analytics = Analytic.search([
+                ('type', '=', 'normal'),
+                ])
+        result = self.distribution(analytics)
+        return self.save_spreadsheet(self.spreadsheet_rows(result, analytics))
+
+    def distribution(self, analytics):
+        # Return the spread amounts by account and analytic account
         pool = Pool()
         Account = pool.get('account.account')
         Analytic = pool.get('analytic_account.account')
@@ -93,6 +143,7 @@ class AnalyticDistributionReport(ModelSQL, ModelView):
         MoveLine = pool.get('account.move.line')
         Company = pool.get('company.company')
         Currency = pool.get('currency.currency')
+        Rule = pool.get('analytic.distribution.report.rule')
 
         cursor = Transaction().connection.cursor()
         table = Analytic.__table__()
@@ -100,20 +151,28 @@ class AnalyticDistributionReport(ModelSQL, ModelView):
         move_line = MoveLine.__table__()
         a_account = Account.__table__()
         company = Company.__table__()
+        rule = Rule.__table__()
 
         # Get analytic credit, debit grouped by account.account
-        id2account = {}
-        for account in Analytic.search([
-                    ('type', '=', 'normal'),
-                    ]):
-            id2account[account.id] = account
+        id2account = dict((a.id, a) for a in analytics)
 
         with Transaction().set_context({
                     'start_date': self.start_date,
                     'end_date': self.end_date,
                     }):
             line_query = Line.query_get(line)
-        cursor.execute(*table.join(line, 'INNER',
+
+        if self.simple_rules():
+            # Move source balances to their targets in the database
+            query_table = table.join(rule, 'LEFT',
+                condition=(rule.source_analytic_account == table.id)
+                & (rule.report == self.id))
+            analytic_column = Coalesce(rule.target_analytic_account,
+                table.id)
+        else:
+            query_table = table
+            analytic_column = table.id
+        cursor.execute(*query_table.join(line, 'INNER',
                 condition=table.id == line.account
                 ).join(move_line, 'LEFT',
                 condition=move_line.id == line.move_line
@@ -121,105 +180,157 @@ class AnalyticDistributionReport(ModelSQL, ModelView):
                 condition=a_account.id == move_line.account
                 ).join(company, 'LEFT',
                 condition=company.id == a_account.company
-                ).select(table.id, move_line.account,
+                ).select(analytic_column, move_line.account,
                 company.currency,
                 Sum(Coalesce(Column(line, 'credit'), 0)) -
                 Sum(Coalesce(Column(line, 'debit'), 0)),
                 where=table.active & line_query
                 & (company.id == self.company.id),
-                group_by=(table.id, move_line.account, company.currency)))
-
-        result = {}
-        id2currency = {}
-        for row in cursor.fetchall():
-            analytic = id2account[row[0]]
-            account_id = row[1]
-            currency_id = row[2]
-            balance = row[3]
-            # SQLite uses float for SUM
-            if not isinstance(balance, Decimal):
-                balance = Decimal(str(balance))
-            if currency_id and currency_id != analytic.currency.id:
-                currency = None
-                if currency_id in id2currency:
-                    currency = id2currency[currency_id]
-                else:
-                    currency = Currency(currency_id)
-                    id2currency[currency.id] = currency
-
-                balance = Currency.compute(currency, balance,
-                    analytic.currency, round=True)
-            else:
-                balance = analytic.currency.round(balance)
-
-            spread = self.spread(analytic, balance)
-            for k, v in spread.items():
-                key = (k, account_id)
-                if key not in result:
-                    result[key] = _ZERO
-                result[key] += v
-
-        # Generate .XLSX
-        wb = Workbook(write_only=True)
-        ws = wb.create_sheet()
+                group_by=(analytic_column, move_line.account,
+                    company.currency)))
+
+        # Share one currency instance per currency, so their fields are read
+        # at once for all of them on first use
+        analytic2currency = dict((a.id, a.currency.id)
+            for a in id2account.values())
+        id2currency = dict((c.id, c) for c in Currency.browse(
+                list(set(analytic2currency.values()))))
+        id2curinfo = dict((a, (c, id2currency[c].round))
+            for a, c in analytic2currency.items())
+        conversion_factors = {}
+
+        # Amounts by account and analytic account
+        result = defaultdict(lambda: defaultdict(lambda: _ZERO))
+        index = self.spread_index()
+
+        # Distributions are symmetric in sign, so cache the positive ones
+        @lru_cache(maxsize=_SPREAD_CACHE_SIZE)
+        def spread(analytic_id, amount):
+            return self.spread(id2account[analytic_id], amount, index)
+
+        # Batches limit the Python rows alive at once; with a client-side
+        # cursor (the psycopg2 default) the driver still holds the whole
+        # result, so peak memory is not lower than with fetchall()
+        while True:
+            rows = cursor.fetchmany(_FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                analytic = id2account[row[0]]
+                account_id = row[1]
+                currency_id = row[2]
+                balance = row[3]
+                # SQLite uses float for SUM
+                if not isinstance(balance, Decimal):
+                    balance = Decimal(str(balance))
+                target_currency_id, rounder = id2curinfo[analytic.id]
+                if currency_id and currency_id != target_currency_id:
+                    # The rates do not depend on the line, so compute the
+                    # conversion factor once per pair of currencies
+                    key = (currency_id, target_currency_id)
+                    factor = conversion_factors.get(key)
+                    if factor is None:
+                        currency = id2currency.get(currency_id)
+                        if currency is None:
+                            currency = Currency(currency_id)
+                            id2currency[currency.id] = currency
+                        factor = Currency.compute(currency, Decimal(1),
+                            id2currency[target_currency_id], round=False)
+                        conversion_factors[key] = factor
+                    balance *= factor
+                balance = rounder(balance)
+
+                account_result = result[account_id]
+                if analytic.id not in index:
+                    account_result[analytic.id] += balance
+                    continue
+                negative = balance.is_signed()
+                for k, v in spread(analytic.id, balance.copy_abs()).items():
+                    account_result[k] += v.copy_negate() if negative else v
+        return result
+
+    def spreadsheet_rows(self, result, analytics):
+        pool = Pool()
+        Account = pool.get('account.account')
 
         # Add header
-        row = [self.name, self.start_date, self.end_date]
-        ws.append(row)
-        ws.append([])
+        yield [self.name, self.start_date, self.end_date]
+        yield []
 
         # Add data
-        analytics = Analytic.search([
-                ('type', '=', 'normal'),
-                ])
         analytics = [dict(name=x.rec_name, id=x.id) for x in analytics]
         analytics.sort(key=lambda x: x['name'])
         totals = defaultdict(lambda: _ZERO)
-        row = [''] + [x['name'] for x in analytics]
-        ws.append(row)
+        yield [''] + [x['name'] for x in analytics]
+
+        analytic_ids = set(x['id'] for x in analytics)
         for account in Account.search([
                     ['OR',
                         ('type.expense', '=', True),
                         ('type.revenue', '=', True),
                         ],
                     ], order=[('code', 'ASC'), ('name', 'ASC')]):
-            to_add = False
-            # Add account name
-            row = [account.rec_name]
-            amount = _ZERO
-            for analytic in analytics:
-                key = (analytic['id'], account.id)
-                value = result.get(key, _ZERO)
-                if value:
-                    to_add = True
-                    amount += value
-                    totals[analytic['id']] += value
-                cell = WriteOnlyCell(ws, value)
-                cell.number_format = _FORMAT
-                row.append(cell)
-            # Add row total
-            cell = WriteOnlyCell(ws, amount)
-            cell.number_format = _FORMAT
-            row.append(cell)
-            if to_add:
-                ws.append(row)
-
-        row = ['']
-        for analytic in analytics:
-            cell = WriteOnlyCell(ws, totals[analytic['id']])
-            cell.number_format = _FORMAT
-            row.append(cell)
-        ws.append(row)
-
-        fd, filename = tempfile.mkstemp()
-        try:
-            os.close(fd)
-            wb.save(filename)
-            with open(filename, 'rb') as f:
-                data = f.read()
-        finally:
-            os.unlink(filename)
-        return data
+            # Only the non zero amounts of the account are looked at, so that
+            # accounts and cells without amounts are skipped
+            values = dict((k, v) for k, v in result.get(account.id, {}).items()
+                if v and k in analytic_ids)
+            if not values:
+                continue
+            for analytic_id, value in values.items():
+                totals[analytic_id] += value
+            # Add account name, amounts and row total leaving empty cells for
+            # the zero amounts
+            yield ([account.rec_name]
+                + [values.get(x['id']) for x in analytics]
+                + [sum(values.values(), _ZERO) or None])
+
+        yield [''] + [totals[x['id']] or None for x in analytics]
+
+    @staticmethod
+    def save_spreadsheet(rows):
+        # Decimal values are written as numbers with _FORMAT
+        data = BytesIO()
+        if xlsxwriter:
+            wb = xlsxwriter.Workbook(data, {
+                    'constant_memory': True,
+                    'default_date_format': 'yyyy-mm-dd',
+                    })
+            ws = wb.add_worksheet()
+            number_format = wb.add_format({'num_format': _FORMAT})
+            for r, row in enumerate(rows):
+                for c, value in enumerate(row):
+                    if isinstance(value, Decimal):
+                        ws.write_number(r, c, float(value), number_format)
+                    elif isinstance(value, str):
+                        # Names must not be turned into formulas or links
+                        ws.write_string(r, c, value)
+                    elif value is not None:
+                        ws.write(r, c, value)
+            wb.close()
+        else:
+            wb = Workbook(write_only=True)
+            wb.add_named_style(NamedStyle(name='amount',
+                    number_format=_FORMAT))
+            ws = wb.create_sheet()
+            for row in rows:
+                cells = []
+                for value in row:
+                    if isinstance(value, Decimal):
+                        cell = WriteOnlyCell(ws, value)
+                        cell.style = 'amount'
+                        value = cell
+                    cells.append(value)
+                ws.append(cells)
+            # The fastest compression level makes the file slightly bigger
+            # but saves most of the time spent compressing it. Workbook.save()
+            # does not allow choosing it, so this copies
+            # openpyxl.writer.excel.save_workbook() with its own ZipFile and
+            # relies on ExcelWriter, which is not documented by openpyxl:
+            # check it when upgrading openpyxl.
+            archive = ZipFile(data, 'w', ZIP_DEFLATED, allowZip64=True,
+                compresslevel=1)
+            ExcelWriter(wb, archive).save()
+        return data.getvalue()
 
 
 class SpreadsheetReport(Report):
@@ -264,17 +375,26 @@ class AnalyticDistributionReportRule(sequence_ordered(), ModelSQL, ModelView,
 
     @classmethod
     def get_ratio(cls, rules, name):
-        report_ids = set([x.report for x in rules])
-
-        amounts = dict([(x, defaultdict(lambda: _ZERO)) for x in report_ids])
-        for rule in cls.search([('report', 'in', report_ids)]):
-            if not rule.amount:
-                continue
-            amounts[rule.report][rule.source_analytic_account] += rule.amount
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        report_ids = list(set(x.report.id for x in rules))
+        amounts = {}
+        for sub_ids in grouped_slice(report_ids):
+            cursor.execute(*table.select(table.report,
+                    table.source_analytic_account, Sum(table.amount),
+                    where=reduce_ids(table.report, sub_ids),
+                    group_by=(table.report, table.source_analytic_account)))
+            for report_id, source_id, amount in cursor.fetchall():
+                # SQLite uses float for SUM
+                if not isinstance(amount, Decimal):
+                    amount = Decimal(str(amount))
+                amounts[(report_id, source_id)] = amount
 
         res = {}
         for rule in rules:
-            total = amounts[rule.report][rule.source_analytic_account]
+            total = amounts.get((rule.report.id,
+                    rule.source_analytic_account.id))
             if total:
                 res[rule.id] = float(rule.amount / total)
             else:
@@ -1,15 +1,467 @@
 # This file is part analytic_distribution_report module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import datetime
 import unittest
-from trytond.tests.test_tryton import ModuleTestCase
+from decimal import Decimal
+from io import BytesIO
+from unittest.mock import patch
+from openpyxl import load_workbook
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.tests.test_tryton import suite as test_suite
+from trytond.pool import Pool
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.currency.tests import create_currency, add_currency_rate
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.analytic_distribution_report import analytic
+
+
+def amounts(result):
+    'Return the non zero amounts of a distribution as plain dicts'
+    res = {}
+    for account_id, values in result.items():
+        values = dict((k, v) for k, v in values.items() if v)
+        if values:
+            res[account_id] = values
+    return res
 
 
 class AnalyticDistributionReportTestCase(ModuleTestCase):
     'Test Analytic Distribution Report module'
     module = 'analytic_distribution_report'
 
+    def create_moves(self, company):
+        """
+        Create analytic accounts and moves with analytic lines, and return
+        a dict with the period and the accounts
+        """
+        pool = Pool()
+        Party = pool.get('party.party')
+        Analytic = pool.get('analytic_account.account')
+        Journal = pool.get('account.journal')
+        Account = pool.get('account.account')
+        Move = pool.get('account.move')
+
+        party = Party(name='Party')
+        party.save()
+        foreign = create_currency('eur')
+        add_currency_rate(foreign, Decimal('1.5'))
+
+        root, foreign_root = Analytic.create([{
+                    'type': 'root',
+                    'name': 'Root',
+                    }, {
+                    'type': 'root',
+                    'name': 'Foreign Root',
+                    'currency': foreign.id,
+                    }])
+        source1, source2, target = Analytic.create([{
+                    'type': 'normal',
+                    'name': name,
+                    'parent': root.id,
+                    'root': root.id,
+                    } for name in ['Source 1', 'Source 2', 'Target']])
+        foreign_analytic, = Analytic.create([{
+                    'type': 'normal',
+                    'name': 'Foreign',
+                    'currency': foreign.id,
+                    'parent': foreign_root.id,
+                    'root': foreign_root.id,
+                    }])
+
+        create_chart(company)
+        fiscalyear = get_fiscalyear(company)
+        fiscalyear.save()
+        fiscalyear.create_period([fiscalyear])
+        period = fiscalyear.periods[0]
+        journal, = Journal.search([
+                ('code', '=', 'REV'),
+                ])
+        revenue, = Account.search([
+                ('type.revenue', '=', True),
+                ])
+        expense, = Account.search([
+                ('type.expense', '=', True),
+                ])
+        receivable, = Account.search([
+                ('type.receivable', '=', True),
+                ])
+
+        def move(account, analytic, debit, credit):
+            return {
+                'period': period.id,
+                'journal': journal.id,
+                'date': period.start_date,
+                'lines': [
+                    ('create', [{
+                                'account': account.id,
+                                'debit': debit,
+                                'credit': credit,
+                                'analytic_lines': [
+                                    ('create', [{
+                                                'account': analytic.id,
+                                                'debit': debit,
+                                                'credit': credit,
+                                                'date': period.start_date,
+                                                }]),
+                                    ],
+                                }, {
+                                'account': receivable.id,
+                                'debit': credit,
+                                'credit': debit,
+                                'party': party.id,
+                                }]),
+                    ],
+                }
+        Move.create([
+                move(revenue, source1, Decimal(0), Decimal('10.01')),
+                move(revenue, source2, Decimal(0), Decimal('20.02')),
+                move(revenue, foreign_analytic, Decimal(0), Decimal('10.01')),
+                move(expense, source1, Decimal('3.33'), Decimal(0)),
+                ])
+        return {
+            'period': period,
+            'revenue': revenue,
+            'expense': expense,
+            'source1': source1,
+            'source2': source2,
+            'target': target,
+            'foreign': foreign_analytic,
+            'move': move,
+            }
+
+    def create_report(self, company, period, rules):
+        pool = Pool()
+        Report = pool.get('analytic.distribution.report')
+
+        report, = Report.create([{
+                    'name': 'Report',
+                    'company': company.id,
+                    'start_date': period.start_date,
+                    'end_date': period.end_date,
+                    'rules': [('create', [{
+                                    'source_analytic_account': source.id,
+                                    'target_analytic_account': target.id,
+                                    'amount': amount,
+                                    } for source, target, amount in rules])],
+                    }])
+        return report
+
+    def create_spreadsheet_report(self, company):
+        """
+        Create a report without rules where the expense amounts cancel out
+        and with an expense account without amounts
+        """
+        pool = Pool()
+        Account = pool.get('account.account')
+        Move = pool.get('account.move')
+
+        data = self.create_moves(company)
+        Move.create([data['move'](data['expense'], data['source2'],
+                    Decimal(0), Decimal('3.33'))])
+        data['unused'], = Account.copy([data['expense']], default={
+                'name': 'Unused Expense',
+                })
+        data['report'] = self.create_report(company, data['period'], [])
+        return data
+
+    def spreadsheet_values(self, content):
+        """
+        Return the cell values of each row of the spreadsheet, checking that
+        amounts have the amount format
+        """
+        ws = load_workbook(BytesIO(content)).active
+        values = []
+        for cells in ws.iter_rows():
+            row = []
+            for cell in cells:
+                if isinstance(cell.value, (int, float)):
+                    self.assertEqual(cell.number_format, analytic._FORMAT)
+                row.append(cell.value if cell.value != '' else None)
+            values.append(row)
+        return values
+
+    def check_spreadsheet(self, values, data):
+        'Check the spreadsheet values of create_spreadsheet_report()'
+        report = data['report']
+        self.assertEqual(values[:3], [
+                [report.name,
+                    datetime.datetime.combine(report.start_date,
+                        datetime.time()),
+                    datetime.datetime.combine(report.end_date,
+                        datetime.time()),
+                    None, None, None],
+                [None] * 6,
+                [None, 'Foreign', 'Source 1', 'Source 2', 'Target', None],
+                ])
+        # Accounts with their amounts by analytic account and row total,
+        # zero amounts and totals are empty cells and accounts without
+        # amounts are skipped
+        self.assertEqual(dict((r[0], r[1:]) for r in values[3:-1]), {
+                data['revenue'].rec_name: [15.02, 10.01, 20.02, None, 45.05],
+                data['expense'].rec_name: [None, -3.33, 3.33, None, None],
+                })
+        self.assertEqual(len(values[3:-1]), 2)
+        self.assertNotIn(data['unused'].rec_name, [r[0] for r in values])
+        # Totals by analytic account, empty for the analytic account without
+        # amounts
+        self.assertEqual(values[-1], [None, 15.02, 6.68, 23.35, None, None])
+
+    def distributions(self, report):
+        """
+        Return the distribution of the report using the database rules when
+        possible and using always the spread in Python
+        """
+        pool = Pool()
+        Report = pool.get('analytic.distribution.report')
+        Analytic = pool.get('analytic_account.account')
+
+        analytics = Analytic.search([
+                ('type', '=', 'normal'),
+                ])
+        result = amounts(report.distribution(analytics))
+        with patch.object(Report, 'simple_rules', return_value=False):
+            python_result = amounts(report.distribution(analytics))
+        return result, python_result
+
+    @with_transaction()
+    def test_distribution_simple_rules(self):
+        'Test distribution with single target rules'
+        company = create_company()
+        with set_company(company):
+            data = self.create_moves(company)
+            report = self.create_report(company, data['period'], [
+                    (data['source1'], data['target'], Decimal(1)),
+                    (data['source2'], data['target'], Decimal(1)),
+                    ])
+            self.assertTrue(report.simple_rules())
+
+            result, python_result = self.distributions(report)
+            self.assertEqual(result, python_result)
+            self.assertEqual(result, {
+                    data['revenue'].id: {
+                        data['target'].id: Decimal('30.03'),
+                        data['foreign'].id: Decimal('15.02'),
+                        },
+                    data['expense'].id: {
+                        data['target'].id: Decimal('-3.33'),
+                        },
+                    })
+
+            # Sources in a foreign currency are spread in Python
+            report = self.create_report(company, data['period'], [
+                    (data['foreign'], data['target'], Decimal(1)),
+                    ])
+            self.assertFalse(report.simple_rules())
+
+    @with_transaction()
+    def test_distribution_split_rules(self):
+        'Test distribution with split and chained rules'
+        company = create_company()
+        with set_company(company):
+            data = self.create_moves(company)
+
+            report = self.create_report(company, data['period'], [
+                    (data['source1'], data['target'], Decimal(1)),
+                    (data['source1'], data['source2'], Decimal(3)),
+                    ])
+            self.assertFalse(report.simple_rules())
+            result, python_result = self.distributions(report)
+            self.assertEqual(result, python_result)
+            self.assertEqual(result, {
+                    data['revenue'].id: {
+                        data['target'].id: Decimal('2.50'),
+                        data['source2'].id: Decimal('27.53'),
+                        data['foreign'].id: Decimal('15.02'),
+                        },
+                    data['expense'].id: {
+                        data['target'].id: Decimal('-0.83'),
+                        data['source2'].id: Decimal('-2.50'),
+                        },
+                    })
+
+            report = self.create_report(company, data['period'], [
+                    (data['source1'], data['target'], Decimal(1)),
+                    (data['target'], data['source2'], Decimal(1)),
+                    ])
+            self.assertFalse(report.simple_rules())
+            result, python_result = self.distributions(report)
+            self.assertEqual(result, python_result)
+            self.assertEqual(result, {
+                    data['revenue'].id: {
+                        data['source2'].id: Decimal('30.03'),
+                        data['foreign'].id: Decimal('15.02'),
+                        },
+                    data['expense'].id: {
+                        data['source2'].id: Decimal('-3.33'),
+                        },
+                    })
+
+    @with_transaction()
+    def test_spread(self):
+        'Test spread'
+        pool = Pool()
+        Report = pool.get('analytic.distribution.report')
+        Analytic = pool.get('analytic_account.account')
+        report = Report()
+
+        # 1 is split to 2 and 3, and 3 is split again to 4 and 5
+        index = {
+            1: [(2, Decimal('0.6')), (3, Decimal('0.4'))],
+            3: [(4, Decimal('0.5')), (5, Decimal('0.5'))],
+            }
+        self.assertEqual(report.spread(Analytic(1), Decimal('100'), index), {
+                2: Decimal('60.00'),
+                4: Decimal('20.00'),
+                5: Decimal('20.00'),
+                })
+        self.assertEqual(report.spread(Analytic(1), Decimal('-100'), index), {
+                2: Decimal('-60.00'),
+                4: Decimal('-20.00'),
+                5: Decimal('-20.00'),
+                })
+        # Accounts without rules keep their amount
+        self.assertEqual(report.spread(Analytic(6), Decimal('12.5'), index), {
+                6: Decimal('12.5'),
+                })
+
+        # The last target takes the rounding difference
+        third = Decimal(str(1 / 3.))
+        index = {
+            1: [(2, third), (3, third), (4, third)],
+            }
+        result = report.spread(Analytic(1), Decimal('100'), index)
+        self.assertEqual(result, {
+                2: Decimal('33.33'),
+                3: Decimal('33.33'),
+                4: Decimal('33.34'),
+                })
+        self.assertEqual(sum(result.values()), Decimal('100'))
+        result = report.spread(Analytic(1), Decimal('-100'), index)
+        self.assertEqual(result, {
+                2: Decimal('-33.33'),
+                3: Decimal('-33.33'),
+                4: Decimal('-33.34'),
+                })
+        self.assertEqual(sum(result.values()), Decimal('-100'))
+
+        # Amounts reaching a target through several rules are added
+        index = {
+            1: [(2, Decimal('0.5')), (3, Decimal('0.5'))],
+            2: [(3, Decimal('1'))],
+            }
+        self.assertEqual(
+            report.spread(Analytic(1), Decimal('-84.35'), index), {
+                3: Decimal('-84.35'),
+                })
+        self.assertEqual(
+            report.spread(Analytic(1), Decimal('84.35'), index), {
+                3: Decimal('84.35'),
+                })
+
+    @with_transaction()
+    def test_rule_ratio(self):
+        'Test rule ratio'
+        pool = Pool()
+        Analytic = pool.get('analytic_account.account')
+        Report = pool.get('analytic.distribution.report')
+
+        company = create_company()
+        with set_company(company):
+            root, = Analytic.create([{
+                        'type': 'root',
+                        'name': 'Root',
+                        }])
+            source1, source2, target1, target2 = Analytic.create([{
+                        'type': 'normal',
+                        'name': name,
+                        'parent': root.id,
+                        'root': root.id,
+                        } for name in ['Source 1', 'Source 2', 'Target 1',
+                        'Target 2']])
+
+            today = datetime.date.today()
+            report1, report2 = Report.create([{
+                        'name': 'Report 1',
+                        'company': company.id,
+                        'start_date': today,
+                        'end_date': today,
+                        'rules': [('create', [{
+                                        'source_analytic_account': source1.id,
+                                        'target_analytic_account': target1.id,
+                                        'amount': Decimal(30),
+                                        }, {
+                                        'source_analytic_account': source1.id,
+                                        'target_analytic_account': target2.id,
+                                        'amount': Decimal(70),
+                                        }, {
+                                        'source_analytic_account': source2.id,
+                                        'target_analytic_account': target1.id,
+                                        'amount': Decimal(0),
+                                        }])],
+                        }, {
+                        'name': 'Report 2',
+                        'company': company.id,
+                        'start_date': today,
+                        'end_date': today,
+                        'rules': [('create', [{
+                                        'source_analytic_account': source1.id,
+                                        'target_analytic_account': target1.id,
+                                        'amount': Decimal(10),
+                                        }])],
+                        }])
+
+            self.assertEqual([r.ratio for r in report1.rules],
+                [0.3, 0.7, 0.0])
+            self.assertEqual([r.ratio for r in report2.rules], [1.0])
+
+    @with_transaction()
+    def test_spreadsheet(self):
+        'Test spreadsheet'
+        company = create_company()
+        with set_company(company):
+            data = self.create_spreadsheet_report(company)
+            report = data['report']
+
+            with patch.object(analytic, 'xlsxwriter', None):
+                content = report.spreadsheet()
+            self.check_spreadsheet(self.spreadsheet_values(content), data)
+
+            # Amounts share the amount named style
+            ws = load_workbook(BytesIO(content)).active
+            for cells in ws.iter_rows():
+                for cell in cells:
+                    if isinstance(cell.value, (int, float)):
+                        self.assertEqual(cell.style, 'amount')
+
+    @unittest.skipIf(xlsxwriter is None, 'xlsxwriter is not installed')
+    @with_transaction()
+    def test_spreadsheet_xlsxwriter(self):
+        'Test spreadsheet with xlsxwriter'
+        company = create_company()
+        with set_company(company):
+            data = self.create_spreadsheet_report(company)
+            report = data['report']
+            report.name = 'http://example.com/report'
+            report.save()
+
+            content = report.spreadsheet()
+            values = self.spreadsheet_values(content)
+            self.check_spreadsheet(values, data)
+            with patch.object(analytic, 'xlsxwriter', None):
+                openpyxl_content = report.spreadsheet()
+            self.assertEqual(values,
+                self.spreadsheet_values(openpyxl_content))
+
+            # The report name is written as a plain string
+            cell = load_workbook(BytesIO(content)).active['A1']
+            self.assertEqual(cell.data_type, 's')
+            self.assertIsNone(cell.hyperlink)
+
 
 def suite():
     suite = test_suite()